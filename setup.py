@@ -19,8 +19,9 @@ setup(
     license=LICENSE,
     keywords=['Proteins', 'Deep Learning', 'Pytorch', 'TAPE'],
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
-        'torch>=1.0',
+        'torch>=2.0',
         'tqdm',
         'tensorboardX',
         'scipy',
@@ -38,9 +39,10 @@ setup(
         ]
     },
     classifiers=[
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Operating System :: POSIX :: Linux',
         'Intended Audience :: Developers',
         'Intended Audience :: Science/Research',
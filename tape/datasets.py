@@ -1,18 +1,24 @@
-from typing import Union, List, Tuple, Sequence, Dict, Any
-from copy import copy
+from typing import Union, List, Tuple, Sequence, Dict, Any, Callable, Optional, Iterable
+from functools import lru_cache
 from pathlib import Path
 import pickle as pkl
 import logging
-import random
+import os
 
 import lmdb
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-from scipy.spatial.distance import pdist, squareform
 
 from .tokenizers import TAPETokenizer
 from .registry import registry
+from .utils import loads_out_of_band
+
+try:
+    from numba import njit
+    NUMBA_FOUND = True
+except ImportError:
+    NUMBA_FOUND = False
 
 logger = logging.getLogger(__name__)
 
@@ -32,15 +38,134 @@ def dataset_factory(data_file: Union[str, Path], *args, **kwargs) -> Dataset:
 
 
 def pad_sequences(sequences: Sequence[np.ndarray], constant_value=0) -> np.ndarray:
-    batch_size = len(sequences)
-    shape = [batch_size] + np.max([seq.shape for seq in sequences], 0).tolist()
-    array = np.zeros(shape, sequences[0].dtype) + constant_value
+    array = np.full(_padded_shape(sequences), constant_value, sequences[0].dtype)
+    _copy_sequences(array, sequences)
+    return array
 
-    for arr, seq in zip(array, sequences):
-        arrslice = tuple(slice(dim) for dim in seq.shape)
-        arr[arrslice] = seq
 
-    return array
+def pad_sequences_many(sequences_list: Sequence[Sequence[np.ndarray]],
+                       constant_values: Sequence[Any],
+                       dtypes: Optional[Sequence[Any]] = None) -> List[torch.Tensor]:
+    """Pads several groups of sequences like pad_sequences, but places all of the padded
+    tensors in a single allocation. Moving the batch then takes one pin and one
+    host-to-device copy of that allocation (see utils.PrefetchLoader) instead of one
+    per tensor.
+
+    Args:
+        sequences_list: Groups of sequences, each group is padded into one tensor.
+        constant_values: Padding value of each group.
+        dtypes (optional): Output dtype of each group. Default: dtype of the sequences.
+    """
+    if dtypes is None:
+        dtypes = [None] * len(sequences_list)
+
+    layout = []
+    nbytes = 0
+    for sequences, dtype in zip(sequences_list, dtypes):
+        shape = _padded_shape(sequences)
+        dtype = np.dtype(sequences[0].dtype if dtype is None else dtype)
+        offset = -(-nbytes // 8) * 8  # keep every tensor 8-byte aligned
+        nbytes = offset + int(np.prod(shape)) * dtype.itemsize
+        layout.append((offset, nbytes, shape, dtype))
+
+    buffer = torch.empty([nbytes], dtype=torch.uint8)
+    tensors = []
+    for sequences, constant_value, (start, end, shape, dtype) in zip(
+            sequences_list, constant_values, layout):
+        torch_dtype = torch.from_numpy(np.empty(0, dtype)).dtype
+        tensor = buffer[start:end].view(torch_dtype).view(shape)
+        array = tensor.numpy()
+        array.fill(constant_value)
+        _copy_sequences(array, sequences)
+        tensors.append(tensor)
+
+    return tensors
+
+
+def _padded_shape(sequences: Sequence[np.ndarray]) -> List[int]:
+    ndim = sequences[0].ndim
+    # A scalar loop is cheaper than np.max over a list of shape tuples for typical batches
+    maxdims = [0] * ndim
+    for seq in sequences:
+        for dim in range(ndim):
+            if seq.shape[dim] > maxdims[dim]:
+                maxdims[dim] = seq.shape[dim]
+    return [len(sequences)] + maxdims
+
+
+def _copy_sequences(array: np.ndarray, sequences: Sequence[np.ndarray]) -> None:
+    if array.ndim == 2:
+        for arr, seq in zip(array, sequences):
+            arr[:seq.shape[0]] = seq
+    else:
+        for arr, seq in zip(array, sequences):
+            arrslice = tuple(slice(dim) for dim in seq.shape)
+            arr[arrslice] = seq
+
+
+def _bert_mask_ids_loop(token_ids: np.ndarray,
+                        mask_id: int,
+                        probs: np.ndarray,
+                        random_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    masked_token_ids = token_ids.copy()
+    labels = np.full_like(token_ids, -1)
+
+    # Tokens begin and end with start_token and stop_token, ignore these
+    for i in range(1, len(token_ids) - 1):
+        prob = probs[i]
+        if prob < 0.15:
+            labels[i] = token_ids[i]
+            if prob < 0.15 * 0.8:
+                # 80% random change to mask token
+                masked_token_ids[i] = mask_id
+            elif prob < 0.15 * 0.9:
+                # 10% chance to change to random token
+                masked_token_ids[i] = random_ids[i]
+
+    return masked_token_ids, labels
+
+
+def _bert_mask_ids_vectorized(token_ids: np.ndarray,
+                              mask_id: int,
+                              probs: np.ndarray,
+                              random_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Same as _bert_mask_ids_loop, used when the loop cannot be compiled with numba
+    masked_token_ids = token_ids.copy()
+    labels = np.full_like(token_ids, -1)
+
+    to_predict = probs < 0.15
+    # Tokens begin and end with start_token and stop_token, ignore these
+    to_predict[0] = to_predict[-1] = False
+    labels[to_predict] = token_ids[to_predict]
+
+    # 80% random change to mask token
+    to_mask = to_predict & (probs < 0.15 * 0.8)
+    masked_token_ids[to_mask] = mask_id
+
+    # 10% chance to change to random token, remaining 10% keep current token
+    to_randomize = to_predict & (probs >= 0.15 * 0.8) & (probs < 0.15 * 0.9)
+    masked_token_ids[to_randomize] = random_ids[to_randomize]
+
+    return masked_token_ids, labels
+
+
+if NUMBA_FOUND:
+    _bert_mask_ids = njit(cache=True)(_bert_mask_ids_loop)
+else:
+    _bert_mask_ids = _bert_mask_ids_vectorized
+
+
+@lru_cache(maxsize=100000)
+def _encode_cached(tokenizer: TAPETokenizer, text: str) -> np.ndarray:
+    return tokenizer.encode(text).astype(np.int32)
+
+
+def encode_cached(tokenizer: TAPETokenizer, text: str) -> np.ndarray:
+    """Tokenizes and encodes a sequence as int32 ids, memoizing the result so that repeated
+    epochs over the same sequences skip tokenization. The cache lives in each worker
+    process. A copy is returned so that callers are free to modify it.
+    """
+    return _encode_cached(tokenizer, text).copy()
 
 
 class FastaDataset(Dataset):
@@ -61,9 +186,18 @@ class FastaDataset(Dataset):
             raise FileNotFoundError(data_file)
 
         # if in_memory:
-        cache = list(SeqIO.parse(str(data_file), 'fasta'))
-        num_examples = len(cache)
-        self._cache = cache
+        # Store records as one ascii blob of sequences plus offsets rather than as SeqRecords
+        ids = []
+        sequences = []
+        for record in SeqIO.parse(str(data_file), 'fasta'):
+            ids.append(record.id)
+            sequences.append(str(record.seq))
+        num_examples = len(ids)
+        offsets = np.zeros([num_examples + 1], np.int64)
+        np.cumsum([len(seq) for seq in sequences], out=offsets[1:])
+        self._ids = ids
+        self._sequences = ''.join(sequences).encode('ascii')
+        self._offsets = offsets
         # else:
             # records = SeqIO.index(str(data_file), 'fasta')
             # num_examples = len(records)
@@ -89,16 +223,16 @@ class FastaDataset(Dataset):
             raise IndexError(index)
 
         # if self._in_memory and self._cache[index] is not None:
-        record = self._cache[index]
+        start, end = self._offsets[index], self._offsets[index + 1]
         # else:
             # key = self._keys[index]
             # record = self._records[key]
             # if self._in_memory:
                 # self._cache[index] = record
 
-        item = {'id': record.id,
-                'primary': str(record.seq),
-                'protein_length': len(record.seq)}
+        item = {'id': self._ids[index],
+                'primary': self._sequences[start:end].decode('ascii'),
+                'protein_length': int(end - start)}
         return item
 
 
@@ -118,17 +252,22 @@ class LMDBDataset(Dataset):
         if not data_file.exists():
             raise FileNotFoundError(data_file)
 
-        env = lmdb.open(str(data_file), max_readers=1, readonly=True,
-                        lock=False, readahead=False, meminit=False)
+        env = _open_lmdb(data_file)
 
         with env.begin(write=False) as txn:
             num_examples = pkl.loads(txn.get(b'num_examples'))
+            # files rewritten by utils.repack_lmdb store numpy buffers out-of-band
+            out_of_band = txn.get(b'out_of_band') is not None
 
         if in_memory:
-            cache = [None] * num_examples
-            self._cache = cache
-
-        self._env = env
+            loads = loads_out_of_band if out_of_band else pkl.loads
+            self._columns = _build_columnar_cache(env, num_examples, loads)
+
+        self._data_file = data_file
+        self._env: Optional[lmdb.Environment] = env
+        self._txn = None
+        self._txn_pid = None
+        self._out_of_band = out_of_band
         self._in_memory = in_memory
         self._num_examples = num_examples
 
@@ -139,17 +278,243 @@ class LMDBDataset(Dataset):
         if not 0 <= index < self._num_examples:
             raise IndexError(index)
 
-        if self._in_memory and self._cache[index] is not None:
-            item = self._cache[index]
+        if self._in_memory:
+            item = {}
+            for name, column in self._columns.items():
+                value = column[index]
+                if value is not _MISSING:
+                    item[name] = value
         else:
-            with self._env.begin(write=False) as txn:
-                item = pkl.loads(txn.get(str(index).encode()))
-                if 'id' not in item:
-                    item['id'] = str(index)
-                if self._in_memory:
-                    self._cache[index] = item
+            data = self._get_txn().get(str(index).encode())
+            if self._out_of_band:
+                # arrays would otherwise point into the lmdb map, so take a copy of the value
+                item = loads_out_of_band(bytes(data))
+            else:
+                item = pkl.loads(data)
+            if 'id' not in item:
+                item['id'] = str(index)
         return item
 
+    def _get_txn(self) -> lmdb.Transaction:
+        # Keep one read transaction open instead of beginning one per example. DataLoader
+        # workers are forked from the main process, so each process opens its own.
+        pid = os.getpid()
+        if self._txn_pid != pid:
+            if self._env is None:
+                self._env = _open_lmdb(self._data_file)
+            self._txn = self._env.begin(write=False, buffers=True)
+            self._txn_pid = pid
+        return self._txn
+
+    def __getstate__(self):
+        # lmdb environments cannot be pickled, e.g. DataLoader workers started with spawn
+        # reopen the file on first access instead
+        state = self.__dict__.copy()
+        state['_env'] = state['_txn'] = state['_txn_pid'] = None
+        return state
+
+
+def _open_lmdb(data_file: Path) -> lmdb.Environment:
+    return lmdb.open(str(data_file), max_readers=1, readonly=True,
+                     lock=False, readahead=False, meminit=False)
+
+
+# Marks values of optional fields that are not present in a record
+_MISSING = object()
+
+
+def _build_columnar_cache(
+        env: lmdb.Environment,
+        num_examples: int,
+        loads: Callable[[bytes], Any]) -> Dict[str, Any]:
+    """Decodes every record of an lmdb file once and stores each field as a column.
+    Numeric fields and fixed-shape array fields are stacked into a single numpy array,
+    anything else (e.g. sequences, variable length arrays or fields missing from some
+    records) is packed into one byte buffer. All columns live in shared memory, so
+    DataLoader workers read the copy built by the main process instead of each holding
+    their own.
+    """
+    columns: Dict[str, List[Any]] = {}
+    with env.begin(write=False) as txn:
+        for index in range(num_examples):
+            item = loads(txn.get(str(index).encode()))
+            if 'id' not in item:
+                item['id'] = str(index)
+            for name, value in item.items():
+                # fields first seen in this record are missing from all previous ones
+                column = columns.setdefault(name, [_MISSING] * index)
+                column.append(value)
+            for column in columns.values():
+                if len(column) == index:
+                    column.append(_MISSING)
+
+    # pop each field's values, so that they are freed as soon as its column is built
+    return {name: _to_column(columns.pop(name)) for name in list(columns)}
+
+
+def _to_column(values: List[Any]) -> Any:
+    first = values[0]
+    if isinstance(first, (int, float, np.number)) and all(
+            type(value) is type(first) for value in values):
+        array = np.asarray(values)
+        if array.dtype.kind in 'biufc':
+            # keep returning python numbers for fields stored as python numbers
+            return _ArrayColumn(_SharedArray.from_array(array),
+                                python_scalars=not isinstance(first, np.number))
+    elif isinstance(first, np.ndarray) and first.dtype.kind in 'biufc':
+        if all(_same_array_type(value, first) for value in values):
+            return _ArrayColumn(_stack_shared(values))
+        elif all(_same_array_kind(value, first) for value in values):
+            return _RaggedArrayColumn(values)
+    return _PackedColumn(values)
+
+
+def _same_array_type(value: Any, reference: np.ndarray) -> bool:
+    if not isinstance(value, np.ndarray):
+        return False
+    return (value.shape, value.dtype) == (reference.shape, reference.dtype)
+
+
+def _same_array_kind(value: Any, reference: np.ndarray) -> bool:
+    # same dtype and number of dimensions, but possibly a different shape
+    if not isinstance(value, np.ndarray):
+        return False
+    return (value.ndim, value.dtype) == (reference.ndim, reference.dtype)
+
+
+class _SharedArray:
+    """A numpy array kept in a torch shared memory tensor.
+
+    Only the tensor is pickled, which multiprocessing's ForkingPickler (used to start
+    DataLoader workers with spawn) sends as a handle to the same memory rather than as a
+    copy. The numpy view is read-only, as a write through it would show up in every process.
+    """
+
+    def __init__(self, shape: Sequence[int], dtype: Any):
+        self._dtype = np.dtype(dtype)
+        self._shape = tuple(int(dim) for dim in shape)
+        nbytes = int(np.prod(self._shape)) * self._dtype.itemsize
+        self._tensor = torch.empty([nbytes], dtype=torch.uint8).share_memory_()
+        self._array: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> '_SharedArray':
+        shared = cls(array.shape, array.dtype)
+        shared.writable_array()[...] = array
+        return shared
+
+    def writable_array(self) -> np.ndarray:
+        # only for filling the array in the process that created it
+        return self._tensor.numpy().view(self._dtype).reshape(self._shape)
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            array = self.writable_array()
+            array.setflags(write=False)
+            self._array = array
+        return self._array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+def _stack_shared(values: Sequence[np.ndarray]) -> _SharedArray:
+    # like np.stack, but writes straight into shared memory
+    shared = _SharedArray((len(values),) + values[0].shape, values[0].dtype)
+    out = shared.writable_array()
+    for i, value in enumerate(values):
+        out[i] = value
+    return shared
+
+
+def _shared_offsets(sizes: Sequence[int]) -> _SharedArray:
+    offsets = np.zeros(len(sizes) + 1, np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return _SharedArray.from_array(offsets)
+
+
+class _ArrayColumn:
+
+    def __init__(self, data: _SharedArray, python_scalars: bool = False):
+        self._data = data
+        self._python_scalars = python_scalars
+
+    def __len__(self) -> int:
+        return len(self._data.array)
+
+    def __getitem__(self, index: int) -> Any:
+        value = self._data.array[index]
+        return value.item() if self._python_scalars else value
+
+
+class _RaggedArrayColumn:
+    """Stores numeric arrays of varying shape (e.g. proteinnet's tertiary coordinates) back
+    to back in one shared buffer, with the offset and shape of each. Items are read-only
+    views into the buffer, so reading one does not decode or copy anything.
+    """
+
+    def __init__(self, values: List[np.ndarray]):
+        self._offsets = _shared_offsets([value.size for value in values])
+        self._shapes = _SharedArray.from_array(
+            np.array([value.shape for value in values], np.int64).reshape(
+                len(values), values[0].ndim))
+
+        offsets = self._offsets.array
+        self._values = _SharedArray([offsets[-1]], values[0].dtype)
+        flat = self._values.writable_array()
+        for value, start, end in zip(values, offsets[:-1], offsets[1:]):
+            flat[start:end] = value.ravel()
+
+    def __len__(self) -> int:
+        return len(self._offsets.array) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        offsets = self._offsets.array
+        return self._values.array[offsets[index]:offsets[index + 1]].reshape(
+            self._shapes.array[index])
+
+
+class _PackedColumn:
+    """Stores strings or other python objects as one shared byte buffer plus offsets.
+    Strings are stored utf-8 encoded, anything else pickled.
+
+    A list of python objects gets copied into every forked worker as soon as their
+    reference counts are touched, a flat buffer does not.
+    """
+
+    def __init__(self, values: List[Any]):
+        self._is_str = all(isinstance(value, str) for value in values)
+        if self._is_str:
+            sizes = [len(value) if value.isascii() else len(value.encode())
+                     for value in values]
+            encoded: Iterable[bytes] = (value.encode() for value in values)
+        else:
+            pickled = [b'' if value is _MISSING else
+                       pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL) for value in values]
+            sizes = [len(value) for value in pickled]
+            encoded = pickled
+
+        self._offsets = _shared_offsets(sizes)
+        offsets = self._offsets.array
+        self._buffer = _SharedArray([offsets[-1]], np.uint8)
+        buffer = self._buffer.writable_array()
+        for value, start, end in zip(encoded, offsets[:-1], offsets[1:]):
+            buffer[start:end] = np.frombuffer(value, np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets.array) - 1
+
+    def __getitem__(self, index: int) -> Any:
+        offsets = self._offsets.array
+        data = self._buffer.array[offsets[index]:offsets[index + 1]]
+        if self._is_str:
+            return data.tobytes().decode()
+        # a pickle is never empty, so an empty entry is a missing value
+        return pkl.loads(data) if len(data) > 0 else _MISSING
+
 
 class JSONDataset(Dataset):
     """Creates a dataset from a json file. Assumes that data is
@@ -209,15 +574,14 @@ class EmbedDataset(Dataset):
 
     def __getitem__(self, index: int):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = self.tokenizer.encode(item['primary']).astype(np.int32)
+        input_mask = np.ones([len(token_ids)], np.uint8)
         return item['id'], token_ids, input_mask
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         ids, tokens, input_mask = zip(*batch)
         ids = list(ids)
-        tokens = torch.from_numpy(pad_sequences(tokens))
-        input_mask = torch.from_numpy(pad_sequences(input_mask))
+        tokens, input_mask = pad_sequences_many([tokens, input_mask], [0, 0])
         return {'ids': ids, 'input_ids': tokens, 'input_mask': input_mask}  # type: ignore
 
 
@@ -244,6 +608,7 @@ class MaskedLanguageModelingDataset(Dataset):
         if isinstance(tokenizer, str):
             tokenizer = TAPETokenizer(vocab=tokenizer)
         self.tokenizer = tokenizer
+        self._mask_id = tokenizer.convert_token_to_id(tokenizer.mask_token)
 
         data_path = Path(data_path)
         data_file = f'pfam/pfam_{split}.lmdb'
@@ -254,25 +619,19 @@ class MaskedLanguageModelingDataset(Dataset):
 
     def __getitem__(self, index):
         item = self.data[index]
-        tokens = self.tokenizer.tokenize(item['primary'])
-        tokens = self.tokenizer.add_special_tokens(tokens)
-        masked_tokens, labels = self._apply_bert_mask(tokens)
-        masked_token_ids = np.array(
-            self.tokenizer.convert_tokens_to_ids(masked_tokens), np.int64)
-        input_mask = np.ones_like(masked_token_ids)
-
-        masked_token_ids = np.array(
-            self.tokenizer.convert_tokens_to_ids(masked_tokens), np.int64)
+        # _apply_bert_mask does not modify its input, so the cached ids can be used directly
+        token_ids = _encode_cached(self.tokenizer, item['primary'])
+        masked_token_ids, labels = self._apply_bert_mask(token_ids)
+        input_mask = np.ones([len(masked_token_ids)], np.uint8)
 
         return masked_token_ids, input_mask, labels, item['clan'], item['family']
 
     def collate_fn(self, batch: List[Any]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, lm_label_ids, clan, family = tuple(zip(*batch))
 
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
         # ignore_index is -1
-        lm_label_ids = torch.from_numpy(pad_sequences(lm_label_ids, -1))
+        input_ids, input_mask, lm_label_ids = pad_sequences_many(
+            [input_ids, input_mask, lm_label_ids], [0, 0, -1], [None, None, np.int64])
         clan = torch.LongTensor(clan)  # type: ignore
         family = torch.LongTensor(family)  # type: ignore
 
@@ -280,34 +639,11 @@ class MaskedLanguageModelingDataset(Dataset):
                 'input_mask': input_mask,
                 'targets': lm_label_ids}
 
-    def _apply_bert_mask(self, tokens: List[str]) -> Tuple[List[str], List[int]]:
-        masked_tokens = copy(tokens)
-        labels = np.zeros([len(tokens)], np.int64) - 1
-
-        for i, token in enumerate(tokens):
-            # Tokens begin and end with start_token and stop_token, ignore these
-            if token in (self.tokenizer.start_token, self.tokenizer.stop_token):
-                pass
-
-            prob = random.random()
-            if prob < 0.15:
-                prob /= 0.15
-                labels[i] = self.tokenizer.convert_token_to_id(token)
-
-                if prob < 0.8:
-                    # 80% random change to mask token
-                    token = self.tokenizer.mask_token
-                elif prob < 0.9:
-                    # 10% chance to change to random token
-                    token = self.tokenizer.convert_id_to_token(
-                        random.randint(0, self.tokenizer.vocab_size - 1))
-                else:
-                    # 10% chance to keep current token
-                    pass
-
-                masked_tokens[i] = token
-
-        return masked_tokens, labels
+    def _apply_bert_mask(self, token_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Draw from torch's generator, which the DataLoader reseeds in every worker
+        probs = torch.rand(len(token_ids)).numpy()
+        random_ids = torch.randint(self.tokenizer.vocab_size, (len(token_ids),)).numpy()
+        return _bert_mask_ids(token_ids, self._mask_id, probs, random_ids)
 
 
 @registry.register_task('language_modeling')
@@ -343,18 +679,17 @@ class LanguageModelingDataset(Dataset):
 
     def __getitem__(self, index):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = self.tokenizer.encode(item['primary']).astype(np.int32)
+        input_mask = np.ones([len(token_ids)], np.uint8)
 
         return token_ids, input_mask, item['clan'], item['family']
 
     def collate_fn(self, batch: List[Any]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, clan, family = tuple(zip(*batch))
 
-        torch_inputs = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
         # ignore_index is -1
-        torch_labels = torch.from_numpy(pad_sequences(input_ids, -1))
+        torch_inputs, input_mask, torch_labels = pad_sequences_many(
+            [input_ids, input_mask, input_ids], [0, 0, -1], [None, None, np.int64])
         clan = torch.LongTensor(clan)  # type: ignore
         family = torch.LongTensor(family)  # type: ignore
 
@@ -388,14 +723,13 @@ class FluorescenceDataset(Dataset):
 
     def __getitem__(self, index: int):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = encode_cached(self.tokenizer, item['primary'])
+        input_mask = np.ones([len(token_ids)], np.uint8)
         return token_ids, input_mask, float(item['log_fluorescence'][0])
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, fluorescence_true_value = tuple(zip(*batch))
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
+        input_ids, input_mask = pad_sequences_many([input_ids, input_mask], [0, 0])
         fluorescence_true_value = torch.FloatTensor(fluorescence_true_value)  # type: ignore
         fluorescence_true_value = fluorescence_true_value.unsqueeze(1)
 
@@ -430,14 +764,13 @@ class StabilityDataset(Dataset):
 
     def __getitem__(self, index: int):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = encode_cached(self.tokenizer, item['primary'])
+        input_mask = np.ones([len(token_ids)], np.uint8)
         return token_ids, input_mask, float(item['stability_score'][0])
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, stability_true_value = tuple(zip(*batch))
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
+        input_ids, input_mask = pad_sequences_many([input_ids, input_mask], [0, 0])
         stability_true_value = torch.FloatTensor(stability_true_value)  # type: ignore
         stability_true_value = stability_true_value.unsqueeze(1)
 
@@ -473,14 +806,13 @@ class RemoteHomologyDataset(Dataset):
 
     def __getitem__(self, index: int):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = encode_cached(self.tokenizer, item['primary'])
+        input_mask = np.ones([len(token_ids)], np.uint8)
         return token_ids, input_mask, item['fold_label']
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, fold_label = tuple(zip(*batch))
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
+        input_ids, input_mask = pad_sequences_many([input_ids, input_mask], [0, 0])
         fold_label = torch.LongTensor(fold_label)  # type: ignore
 
         return {'input_ids': input_ids,
@@ -488,6 +820,44 @@ class RemoteHomologyDataset(Dataset):
                 'targets': fold_label}
 
 
+# Per-process buffer with the |i - j| < 6 mask for the longest protein seen so far
+_short_range_buffer = np.zeros([0, 0], np.bool_)
+
+
+def _short_range_mask(length: int) -> np.ndarray:
+    """Returns a read-only [length, length] view marking residue pairs less than 6 apart
+    in sequence, sliced out of a buffer that is only rebuilt when a longer protein shows up.
+    """
+    global _short_range_buffer
+    if len(_short_range_buffer) < length:
+        indices = np.arange(length)
+        _short_range_buffer = np.abs(indices[:, None] - indices[None, :]) < 6
+        _short_range_buffer.setflags(write=False)
+    return _short_range_buffer[:length, :length]
+
+
+if NUMBA_FOUND:
+    # Not parallel: DataLoader workers already run in parallel, and with numba's tbb
+    # threading layer a process that forks after starting its thread pool hangs on exit
+    @njit(fastmath=True, cache=True)
+    def _contact_map_kernel(coords, valid_mask, out):
+        # Same labels as the gemm path: 1 for residues closer than 8 angstrom, 0 otherwise
+        # and -1 for invalid residues or pairs less than 6 apart in sequence
+        length = coords.shape[0]
+        for i in range(length):
+            out[i, i] = -1
+            for j in range(i + 1, length):
+                if j - i < 6 or not (valid_mask[i] and valid_mask[j]):
+                    value = -1
+                else:
+                    dx = coords[i, 0] - coords[j, 0]
+                    dy = coords[i, 1] - coords[j, 1]
+                    dz = coords[i, 2] - coords[j, 2]
+                    value = 1 if dx * dx + dy * dy + dz * dz < 64.0 else 0
+                out[i, j] = value
+                out[j, i] = value
+
+
 @registry.register_task('contact_prediction')
 class ProteinnetDataset(Dataset):
 
@@ -506,8 +876,17 @@ class ProteinnetDataset(Dataset):
         self.tokenizer = tokenizer
 
         data_path = Path(data_path)
-        data_file = f'proteinnet/proteinnet_{split}.lmdb'
-        self.data = dataset_factory(data_path / data_file, in_memory)
+        data_file = data_path / f'proteinnet/proteinnet_{split}.lmdb'
+        self.data = dataset_factory(data_file, in_memory)
+
+        self._data_file = data_file
+        self._contact_cache_file = data_file.with_suffix('.contacts.npy')
+        self._contact_offsets_file = data_file.with_suffix('.contact_offsets.npy')
+        self._contact_maps = None
+        self._contact_offsets = None
+        # offsets are written last, so their presence marks a complete cache
+        if self._contact_offsets_file.exists():
+            self._load_contact_cache()
 
     def __len__(self) -> int:
         return len(self.data)
@@ -515,24 +894,97 @@ class ProteinnetDataset(Dataset):
     def __getitem__(self, index: int):
         item = self.data[index]
         protein_length = len(item['primary'])
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = encode_cached(self.tokenizer, item['primary'])
+        input_mask = np.ones([len(token_ids)], np.uint8)
+
+        if self._contact_offsets is not None:
+            if self._contact_maps is None:
+                self._contact_maps = np.load(self._contact_cache_file, mmap_mode='r')
+            start, end = self._contact_offsets[index], self._contact_offsets[index + 1]
+            contact_map = self._contact_maps[start:end].reshape(protein_length, protein_length)
+        else:
+            contact_map = self._compute_contact_map(item)
 
-        valid_mask = item['valid_mask']
-        contact_map = np.less(squareform(pdist(item['tertiary'])), 8.0).astype(np.int64)
+        return token_ids, input_mask, contact_map, protein_length
 
-        yind, xind = np.indices(contact_map.shape)
-        invalid_mask = ~(valid_mask[:, None] & valid_mask[None, :])
-        invalid_mask |= np.abs(yind - xind) < 6
+    def prepare_cache(self) -> None:
+        """Precomputes the contact map of every protein and writes them next to the lmdb
+        file as a flat int8 array plus per-protein offsets. Once the cache exists, it is
+        memory-mapped and contact maps are sliced out of it instead of being recomputed
+        every epoch. The cache is ignored if the lmdb file has changed since.
+        """
+        lengths = np.array([len(self.data[i]['primary']) for i in range(len(self))], np.int64)
+        offsets = np.zeros([len(lengths) + 1], np.int64)
+        np.cumsum(lengths ** 2, out=offsets[1:])
+
+        contact_maps = np.lib.format.open_memmap(
+            str(self._contact_cache_file), mode='w+', dtype=np.int8, shape=(int(offsets[-1]),))
+        for i in range(len(self)):
+            contact_maps[offsets[i]:offsets[i + 1]] = self._compute_contact_map(
+                self.data[i]).ravel()
+        contact_maps.flush()
+        del contact_maps
+
+        # the lmdb file's size and modification time are stored after the offsets, so a
+        # cache built from a different version of the file can be detected on load
+        np.save(self._contact_offsets_file, np.append(offsets, self._data_stamp()))
+        self._load_contact_cache()
+
+    def _load_contact_cache(self) -> None:
+        offsets = np.load(self._contact_offsets_file)
+        offsets, stamp = offsets[:-2], offsets[-2:]
+        if len(offsets) != len(self.data) + 1 or not np.array_equal(stamp, self._data_stamp()):
+            logger.warning(f"Contact map cache {self._contact_cache_file} was built from "
+                           f"a different version of {self._data_file}, ignoring it")
+            return
+        self._contact_offsets = offsets
+        # the maps themselves are memory-mapped on first access in each process
+
+    def _data_stamp(self) -> np.ndarray:
+        data_file = self._data_file
+        if data_file.is_dir():
+            data_file = data_file / 'data.mdb'
+        stat = data_file.stat()
+        return np.array([stat.st_size, stat.st_mtime_ns], np.int64)
+
+    def __getstate__(self):
+        # a memmap pickles by value, so workers started with spawn reopen the file instead
+        state = self.__dict__.copy()
+        state['_contact_maps'] = None
+        return state
+
+    def _compute_contact_map(self, item: Dict[str, Any]) -> np.ndarray:
+        valid_mask = item['valid_mask']
+        if NUMBA_FOUND:
+            length = len(valid_mask)
+            contact_map = np.empty([length, length], np.int64)
+            _contact_map_kernel(item['tertiary'], valid_mask, contact_map)
+            return contact_map
+
+        # squared distances via |x|^2 + |y|^2 - 2xy, compared against 8.0 ** 2. The terms
+        # cancel, so center the coordinates and stay in float64 to match pdist exactly.
+        coords = item['tertiary'].astype(np.float64)
+        if valid_mask.any():
+            coords -= coords[valid_mask].mean(0)
+        sq_norms = np.einsum('ij,ij->i', coords, coords)
+        dist_sq = coords @ coords.T
+        dist_sq *= -2
+        dist_sq += sq_norms[:, None]
+        dist_sq += sq_norms[None, :]
+        contact_map = np.less(dist_sq, 64.0).astype(np.int64)
+
+        invalid_mask = np.logical_and.outer(valid_mask, valid_mask)
+        np.logical_not(invalid_mask, out=invalid_mask)
+        invalid_mask |= _short_range_mask(len(contact_map))
         contact_map[invalid_mask] = -1
 
-        return token_ids, input_mask, contact_map, protein_length
+        return contact_map
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, contact_labels, protein_length = tuple(zip(*batch))
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
-        contact_labels = torch.from_numpy(pad_sequences(contact_labels, -1))
+        # cached contact maps are stored as int8, loss expects int64
+        input_ids, input_mask, contact_labels = pad_sequences_many(
+            [input_ids, input_mask, contact_labels], [0, 0, -1], [None, None, np.int64])
         protein_length = torch.LongTensor(protein_length)  # type: ignore
 
         return {'input_ids': input_ids,
@@ -567,20 +1019,21 @@ class SecondaryStructureDataset(Dataset):
 
     def __getitem__(self, index: int):
         item = self.data[index]
-        token_ids = self.tokenizer.encode(item['primary'])
-        input_mask = np.ones_like(token_ids)
+        token_ids = encode_cached(self.tokenizer, item['primary'])
+        input_mask = np.ones([len(token_ids)], np.uint8)
 
         # pad with -1s because of cls/sep tokens
-        labels = np.asarray(item['ss3'], np.int64)
-        labels = np.pad(labels, (1, 1), 'constant', constant_values=-1)
+        ss3 = item['ss3']
+        labels = np.empty([len(ss3) + 2], np.int64)
+        labels[0] = labels[-1] = -1
+        labels[1:-1] = ss3
 
         return token_ids, input_mask, labels
 
     def collate_fn(self, batch: List[Tuple[Any, ...]]) -> Dict[str, torch.Tensor]:
         input_ids, input_mask, ss_label = tuple(zip(*batch))
-        input_ids = torch.from_numpy(pad_sequences(input_ids, 0))
-        input_mask = torch.from_numpy(pad_sequences(input_mask, 0))
-        ss_label = torch.from_numpy(pad_sequences(ss_label, -1))
+        input_ids, input_mask, ss_label = pad_sequences_many(
+            [input_ids, input_mask, ss_label], [0, 0, -1])
 
         output = {'input_ids': input_ids,
                   'input_mask': input_mask,
@@ -81,6 +81,8 @@ class ForwardRunner:
         if self.device.type == 'cuda':
             batch = {name: tensor.cuda(device=self.device, non_blocking=True)
                      for name, tensor in batch.items()}
+        # Datasets emit int32 token ids to keep batches small, embeddings index with int64
+        batch['input_ids'] = batch['input_ids'].long()
 
         outputs = self.model(**batch)
 
@@ -438,6 +440,9 @@ def run_train(model_type: str,
     valid_loader = utils.setup_loader(
         valid_dataset, batch_size, local_rank, n_gpu,
         gradient_accumulation_steps, num_workers)
+    if device.type == 'cuda':
+        train_loader = utils.PrefetchLoader(train_loader, device)  # type: ignore
+        valid_loader = utils.PrefetchLoader(valid_loader, device)  # type: ignore
 
     num_train_optimization_steps = utils.get_num_train_optimization_steps(
         train_dataset, batch_size, num_train_epochs)
@@ -574,6 +579,8 @@ def run_eval(model_type: str,
     valid_loader = utils.setup_loader(
         valid_dataset, batch_size, local_rank, n_gpu,
         1, num_workers)
+    if device.type == 'cuda':
+        valid_loader = utils.PrefetchLoader(valid_loader, device)  # type: ignore
 
     metric_functions = [registry.get_metric(name) for name in metrics]
     save_outputs = run_eval_epoch(valid_loader, runner, is_master)
@@ -623,6 +630,8 @@ def run_embed(model_type: str,
 
     dataset = task_spec.dataset(data_file, tokenizer=tokenizer)  # type: ignore
     valid_loader = utils.setup_loader(dataset, batch_size, local_rank, n_gpu, 1, num_workers)
+    if device.type == 'cuda':
+        valid_loader = utils.PrefetchLoader(valid_loader, device)  # type: ignore
 
     with utils.IncrementalNPZ(out_file) as npzfile:
         with utils.wrap_cuda_oom_error(local_rank, batch_size, n_gpu):
@@ -10,7 +10,11 @@ from .utils import set_random_seeds  # noqa: F401
 from .utils import MetricsAccumulator  # noqa: F401
 from .utils import wrap_cuda_oom_error  # noqa: F401
 from .utils import write_lmdb  # noqa: F401
+from .utils import repack_lmdb  # noqa: F401
+from .utils import dumps_out_of_band  # noqa: F401
+from .utils import loads_out_of_band  # noqa: F401
 from .utils import IncrementalNPZ  # noqa: F401
+from .utils import PrefetchLoader  # noqa: F401
 
 from .setup_utils import setup_logging  # noqa: F401
 from .setup_utils import setup_optimizer  # noqa: F401
@@ -1,95 +1,78 @@
-"""Implementation of a bucketed data sampler from PyTorch-NLP.
-Modified by Roshan Rao.
+"""Length bucketed batch sampler. Replaces the bucketed data sampler adapted from
+PyTorch-NLP by Roshan Rao.
 
 See https://github.com/PetrochukM/PyTorch-NLP/
 """
 import typing
 import math
-import operator
-from torch.utils.data.sampler import Sampler
+import numpy as np
+import torch
 from torch.utils.data.sampler import BatchSampler
-from torch.utils.data.sampler import SubsetRandomSampler
 
 
-class SortedSampler(Sampler):
-    """ Samples elements sequentially, always in the same order.
-    Args:
-        data (iterable): Iterable data.
-        sort_key (callable): Specifies a function of one argument that is used to extract a
-            numerical comparison key from each list element.
-    Example:
-        >>> list(SortedSampler(range(10), sort_key=lambda i: -i))
-        [9, 8, 7, 6, 5, 4, 3, 2, 1, 0]
-    """
-
-    def __init__(self,
-                 dataset,
-                 sort_key: typing.Callable[[int], typing.Any],
-                 indices: typing.Optional[typing.Iterable[int]] = None):
-        super().__init__(dataset)
-        self.dataset = dataset
-        self.sort_key = sort_key
-        if indices is None:
-            sort_keys = map(sort_key, dataset)
-        else:
-            sort_keys = ((i, sort_key(dataset[i])) for i in indices)
-        self.sorted_indices = [i for i, _ in sorted(sort_keys, key=operator.itemgetter(1))]
-
-    def __iter__(self):
-        return iter(self.sorted_indices)
-
-    def __len__(self):
-        return len(self.dataset)
-
+class LengthBucketSampler(BatchSampler):
+    """ `LengthBucketSampler` only batches together examples of similar length.
+    Each index drawn from `sampler` is assigned to a bucket by its length and batches are
+    formed within a bucket, so padding is bounded by the width of the bucket instead of by
+    the longest sequence in a random batch. Examples left over once a bucket cannot fill
+    another batch are batched together across buckets, so the number of batches is the
+    same as for a plain ``BatchSampler``; with a ``DistributedSampler`` every rank gets
+    the same number of batches. The order of the batches is shuffled.
 
-class BucketBatchSampler(BatchSampler):
-    """ `BucketBatchSampler` toggles between `sampler` batches and sorted batches.
-    Typically, the `sampler` will be a `RandomSampler` allowing the user to toggle between
-    random batches and sorted batches. A larger `bucket_size_multiplier` is more sorted
-    and vice versa. Provides ~10-25 percent speedup.
-
-    Background:
-        ``BucketBatchSampler`` is similar to a ``BucketIterator`` found in popular
-        libraries like ``AllenNLP`` and ``torchtext``. A ``BucketIterator`` pools together
-        examples with a similar size length to reduce the padding required for each batch
-        while maintaining some noise through bucketing.
+    Lengths are given up front, so the dataset does not have to be indexed to sort
+    each bucket.
 
     Args:
         sampler (torch.data.utils.sampler.Sampler):
         batch_size (int): Size of mini-batch.
-        drop_last (bool): If `True` the sampler will drop the last batch if its size
-            would be less than `batch_size`.
-        sort_key (callable, optional): Callable to specify a comparison key for sorting.
-        bucket_size_multiplier (int, optional): Buckets are of size
-            `batch_size * bucket_size_multiplier`.
+        drop_last (bool): If `True` the sampler will drop the last batch if its size would
+            be less than `batch_size`.
+        lengths (sequence of int): Length of every example in the dataset.
+        bucket_boundaries (sequence of int, optional): Lengths at which a new bucket
+            starts. Default: the deciles of `lengths`, giving ten equally full buckets.
     Example:
         >>> from torch.utils.data.sampler import SequentialSampler
-        >>> sampler = SequentialSampler(list(range(10)))
-        >>> list(BucketBatchSampler(sampler, batch_size=3, drop_last=False))
-        [[6, 7, 8], [0, 1, 2], [3, 4, 5], [9]]
-        >>> list(BucketBatchSampler(sampler, batch_size=3, drop_last=True))
-        [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+        >>> sampler = SequentialSampler(list(range(6)))
+        >>> lengths = [10, 50, 12, 48, 11, 52]
+        >>> sorted(LengthBucketSampler(sampler, 3, False, lengths, bucket_boundaries=[30]))
+        [[0, 2, 4], [1, 3, 5]]
     """
 
     def __init__(self,
                  sampler,
-                 batch_size,
-                 drop_last,
-                 sort_key,
-                 dataset,
-                 bucket_size_multiplier=100):
+                 batch_size: int,
+                 drop_last: bool,
+                 lengths: typing.Sequence[int],
+                 bucket_boundaries: typing.Optional[typing.Sequence[int]] = None):
         super().__init__(sampler, batch_size, drop_last)
-        self.sort_key = sort_key
-        self.dataset = dataset
-        self.bucket_sampler = BatchSampler(
-            sampler, min(batch_size * bucket_size_multiplier, len(sampler)), False)
+        lengths = np.asarray(lengths)
+        if bucket_boundaries is None:
+            bucket_boundaries = np.unique(np.percentile(lengths, np.arange(10, 100, 10)))
+        self.bucket_boundaries = bucket_boundaries
+        self.bucket_ids = np.searchsorted(bucket_boundaries, lengths, side='right')
+        self.num_buckets = len(bucket_boundaries) + 1
 
     def __iter__(self):
-        for bucket in self.bucket_sampler:
-            sorted_sampler = SortedSampler(self.dataset, self.sort_key, indices=bucket)
-            for batch in SubsetRandomSampler(
-                    list(BatchSampler(sorted_sampler, self.batch_size, self.drop_last))):
-                yield batch
+        buckets: typing.List[typing.List[int]] = [[] for _ in range(self.num_buckets)]
+        for index in self.sampler:
+            buckets[self.bucket_ids[index]].append(index)
+
+        # Full batches are formed within a bucket, the leftovers of all buckets are merged
+        # (still ordered by bucket) so the number of batches only depends on len(sampler)
+        batches = []
+        leftovers: typing.List[int] = []
+        for bucket in buckets:
+            num_full = len(bucket) - len(bucket) % self.batch_size
+            for start in range(0, num_full, self.batch_size):
+                batches.append(bucket[start:start + self.batch_size])
+            leftovers.extend(bucket[num_full:])
+        for start in range(0, len(leftovers), self.batch_size):
+            batch = leftovers[start:start + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                batches.append(batch)
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
 
     def __len__(self):
         if self.drop_last:
@@ -14,7 +14,7 @@ from ..optimization import AdamW
 from ..registry import registry
 
 from .utils import get_effective_batch_size
-from ._sampler import BucketBatchSampler
+from ._sampler import LengthBucketSampler
 
 logger = logging.getLogger(__name__)
 
@@ -103,9 +103,8 @@ def setup_loader(dataset: Dataset,
     sampler = DistributedSampler(dataset) if local_rank != -1 else RandomSampler(dataset)
     batch_size = get_effective_batch_size(
         batch_size, local_rank, n_gpu, gradient_accumulation_steps) * n_gpu
-    # WARNING: this will fail if the primary sequence is not the first thing the dataset returns
-    batch_sampler = BucketBatchSampler(
-        sampler, batch_size, False, lambda x: len(x[0]), dataset)
+    batch_sampler = LengthBucketSampler(
+        sampler, batch_size, False, _get_sequence_lengths(dataset))
 
     loader = DataLoader(
         dataset,
@@ -116,6 +115,19 @@ def setup_loader(dataset: Dataset,
     return loader
 
 
+def _get_sequence_lengths(dataset: Dataset) -> typing.List[int]:
+    # Read lengths from the raw records where possible, which avoids tokenizing (and e.g.
+    # building contact maps for) every example just to bucket it
+    data = getattr(dataset, 'data', None)
+    if data is not None:
+        try:
+            return [len(data[i]['primary']) for i in range(len(data))]  # type: ignore
+        except (KeyError, TypeError):
+            pass
+    # WARNING: this will fail if the primary sequence is not the first thing the dataset returns
+    return [len(dataset[i][0]) for i in range(len(dataset))]  # type: ignore
+
+
 def setup_distributed(local_rank: int,
                       no_cuda: bool) -> typing.Tuple[torch.device, int, bool]:
     if local_rank != -1 and not no_cuda:
@@ -7,6 +7,10 @@ from datetime import datetime
 import os
 import argparse
 import contextlib
+import struct
+import pickle as pkl
+import queue
+import threading
 from collections import defaultdict
 
 import numpy as np
@@ -255,7 +259,6 @@ def write_lmdb(filename: str, iterable: typing.Iterable, map_size: int = 2 ** 20
             You will likely have to increase this. Default: 1MB.
     """
     import lmdb
-    import pickle as pkl
     env = lmdb.open(filename, map_size=map_size)
 
     with env.begin(write=True) as txn:
@@ -265,6 +268,69 @@ def write_lmdb(filename: str, iterable: typing.Iterable, map_size: int = 2 ** 20
     env.close()
 
 
+def dumps_out_of_band(obj: typing.Any) -> bytes:
+    """Pickles an object with protocol 5, storing its buffers (e.g. numpy array data)
+    out-of-band after the pickle stream rather than copying them into it.
+
+    Layout: a uint32 buffer count, uint64 lengths of the pickle stream and of each buffer,
+    followed by the pickle stream and the raw buffers.
+    """
+    buffers: typing.List[pkl.PickleBuffer] = []
+    payload = pkl.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raw_buffers = [buffer.raw() for buffer in buffers]
+    lengths = [len(payload)] + [raw.nbytes for raw in raw_buffers]
+    header = struct.pack(f'<I{len(lengths)}Q', len(raw_buffers), *lengths)
+    return b''.join([header, payload] + [raw.tobytes() for raw in raw_buffers])
+
+
+def loads_out_of_band(data: typing.Union[bytes, memoryview]) -> typing.Any:
+    """Inverse of dumps_out_of_band. Buffers are passed to pickle as views into `data`,
+    so numpy arrays are reconstructed without copying (and are read-only).
+    """
+    view = memoryview(data)
+    num_buffers, = struct.unpack_from('<I', view)
+    lengths = struct.unpack_from(f'<{num_buffers + 1}Q', view, 4)
+    offset = 4 + 8 * (num_buffers + 1)
+    payload = view[offset:offset + lengths[0]]
+    offset += lengths[0]
+    buffers = []
+    for length in lengths[1:]:
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return pkl.loads(payload, buffers=buffers)
+
+
+def repack_lmdb(in_file: str, out_file: str, map_size: typing.Optional[int] = None):
+    """Rewrites a dataset LMDB file so that each record is stored with dumps_out_of_band.
+    LMDBDataset detects repacked files and reads numpy fields (e.g. proteinnet's
+    tertiary coordinates) without an extra copy.
+
+    Args:
+        in_file (str): LMDB file to read, as written by write_lmdb
+        out_file (str): Output filename to write to
+        map_size (int, optional): Maximum allowable size of the output database in bytes.
+            Default: twice the map size of the input database.
+    """
+    import lmdb
+    if pkl.HIGHEST_PROTOCOL < 5:
+        raise RuntimeError("Repacking LMDB files requires pickle protocol 5 (python >= 3.8)")
+
+    in_env = lmdb.open(in_file, max_readers=1, readonly=True,
+                       lock=False, readahead=False, meminit=False)
+    if map_size is None:
+        map_size = 2 * in_env.info()['map_size']
+    out_env = lmdb.open(out_file, map_size=map_size)
+
+    with in_env.begin(write=False) as in_txn, out_env.begin(write=True) as out_txn:
+        for key, value in in_txn.cursor():
+            if key.isdigit():
+                value = dumps_out_of_band(pkl.loads(value))
+            out_txn.put(key, value)
+        out_txn.put(b'out_of_band', pkl.dumps(True))
+    in_env.close()
+    out_env.close()
+
+
 class IncrementalNPZ(object):
     # Modified npz that allows incremental saving, from https://stackoverflow.com/questions/22712292/how-to-use-numpy-savez-in-a-loop-for-save-more-than-one-array  # noqa: E501
     def __init__(self, file):
@@ -325,3 +391,99 @@ class IncrementalNPZ(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
+
+
+class PrefetchLoader:
+    """Wraps a DataLoader so that upcoming batches are copied to the GPU ahead of time. A
+    background thread pulls batches from the loader, pins them and issues their
+    host-to-device copies on a separate CUDA stream, overlapping them with compute on the
+    current batch. Tensors that share one allocation (see datasets.pad_sequences_many)
+    are pinned and copied together.
+
+    This is the only place batches get pinned: loaders are created without pin_memory, and
+    CPU-only runs do not wrap them, so nothing is pinned there.
+
+    Args:
+        loader (DataLoader): The loader to wrap.
+        device (torch.device): CUDA device to copy batches to.
+        depth (int, optional): Number of batches to copy ahead. Default: 2.
+    """
+
+    def __init__(self,
+                 loader: typing.Iterable,
+                 device: torch.device,
+                 depth: int = 2):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+
+    def __len__(self) -> int:
+        return len(self.loader)  # type: ignore
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches: queue.Queue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._produce, args=(stream, batches, stop), daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                entry = batches.get()
+                if entry is None:
+                    break
+                elif isinstance(entry, Exception):
+                    raise entry
+                batch, copied = entry
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(copied)
+                for value in batch.values():
+                    if isinstance(value, torch.Tensor):
+                        # memory was allocated on the copy stream, but is used on this one
+                        value.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
+    def _produce(self, stream: torch.cuda.Stream, batches: queue.Queue, stop: threading.Event):
+
+        def put(entry) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with torch.cuda.stream(stream):
+                for batch in self.loader:
+                    batch = self._to_device(batch)
+                    copied = torch.cuda.Event()
+                    copied.record(stream)
+                    if not put((batch, copied)):
+                        return
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
+
+    def _to_device(self, batch: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+        device_storages: typing.Dict[int, torch.UntypedStorage] = {}
+        device_batch = {}
+        for name, value in batch.items():
+            if not isinstance(value, torch.Tensor):
+                device_batch[name] = value
+                continue
+            storage = value.untyped_storage()
+            key = storage.data_ptr()
+            if key not in device_storages:
+                if not storage.is_pinned():
+                    storage = storage.pin_memory()
+                device_storages[key] = storage.cuda(self.device, non_blocking=True)
+            device_batch[name] = torch.empty(0, dtype=value.dtype, device=self.device).set_(
+                device_storages[key], value.storage_offset(), value.size(), value.stride())
+        return device_batch
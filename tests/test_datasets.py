@@ -0,0 +1,288 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from scipy.spatial.distance import pdist, squareform
+
+from tape import datasets
+
+
+def _random_protein(rng, length):
+    # random walk with C-alpha spacing, shifted like coordinates in a PDB frame
+    steps = rng.randn(length, 3)
+    steps *= 3.8 / np.linalg.norm(steps, axis=1, keepdims=True)
+    coords = np.cumsum(steps, axis=0) + rng.uniform(-300, 300, size=3)
+    return {'primary': 'A' * length,
+            'tertiary': coords,
+            'valid_mask': rng.rand(length) > 0.1}
+
+
+def _reference_contact_map(item):
+    contact_map = np.less(squareform(pdist(item['tertiary'])), 8.0).astype(np.int64)
+    yind, xind = np.indices(contact_map.shape)
+    invalid_mask = ~(item['valid_mask'][:, None] & item['valid_mask'][None, :])
+    invalid_mask |= np.abs(yind - xind) < 6
+    contact_map[invalid_mask] = -1
+    return contact_map
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_contact_map_matches_pdist(monkeypatch, use_numba):
+    if use_numba and not datasets.NUMBA_FOUND:
+        pytest.skip('numba is not installed')
+    monkeypatch.setattr(datasets, 'NUMBA_FOUND', use_numba)
+
+    rng = np.random.RandomState(0)
+    dataset = datasets.ProteinnetDataset.__new__(datasets.ProteinnetDataset)
+    for _ in range(20):
+        item = _random_protein(rng, 600)
+        np.testing.assert_array_equal(
+            dataset._compute_contact_map(item), _reference_contact_map(item))
+
+
+def _write_proteinnet(data_path, records):
+    from tape.utils import write_lmdb
+    (data_path / 'proteinnet').mkdir(parents=True)
+    data_file = data_path / 'proteinnet' / 'proteinnet_valid.lmdb'
+    write_lmdb(str(data_file), records, map_size=2 ** 24)
+    return data_file
+
+
+def test_contact_map_cache_matches_computed_maps(tmp_path):
+    rng = np.random.RandomState(0)
+    _write_proteinnet(tmp_path, [_random_protein(rng, length) for length in [10, 31, 17]])
+    dataset = datasets.ProteinnetDataset(tmp_path, 'valid')
+    computed = [dataset[i][2] for i in range(len(dataset))]
+
+    dataset.prepare_cache()
+    assert dataset._contact_offsets is not None
+    for i, contact_map in enumerate(computed):
+        np.testing.assert_array_equal(dataset[i][2], contact_map)
+    assert isinstance(dataset._contact_maps, np.memmap)
+
+    # workers started with spawn reopen the memmap instead of receiving a copy of it
+    assert dataset.__getstate__()['_contact_maps'] is None
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=1, collate_fn=list, num_workers=1,
+        multiprocessing_context='spawn')
+    for contact_map, (item,) in zip(computed, loader):
+        np.testing.assert_array_equal(item[2], contact_map)
+
+
+def test_stale_contact_map_cache_is_ignored(tmp_path):
+    rng = np.random.RandomState(0)
+    old_file = _write_proteinnet(
+        tmp_path / 'old', [_random_protein(rng, length) for length in [10, 31, 17]])
+    datasets.ProteinnetDataset(tmp_path / 'old', 'valid').prepare_cache()
+
+    records = [_random_protein(rng, length) for length in [12, 31, 17]]
+    for num_records in [2, 3]:
+        new_file = _write_proteinnet(tmp_path / str(num_records), records[:num_records])
+        for suffix in ['.contacts.npy', '.contact_offsets.npy']:
+            new_file.with_suffix(suffix).write_bytes(old_file.with_suffix(suffix).read_bytes())
+
+        dataset = datasets.ProteinnetDataset(tmp_path / str(num_records), 'valid')
+        assert dataset._contact_offsets is None
+        for i, item in enumerate(records[:num_records]):
+            np.testing.assert_array_equal(dataset[i][2], _reference_contact_map(item))
+
+
+def test_contact_map_cache_of_rewritten_lmdb_is_ignored(tmp_path):
+    import gc
+    import shutil
+    from tape.utils import write_lmdb
+    rng = np.random.RandomState(0)
+    lengths = [10, 31, 17]
+    data_file = _write_proteinnet(tmp_path, [_random_protein(rng, n) for n in lengths])
+    dataset = datasets.ProteinnetDataset(tmp_path, 'valid')
+    dataset.prepare_cache()
+    del dataset
+    gc.collect()  # closes the lmdb environment
+
+    # same number of proteins with the same lengths, but different structures
+    records = [_random_protein(rng, n) for n in lengths]
+    shutil.rmtree(data_file)
+    write_lmdb(str(data_file), records, map_size=2 ** 24)
+
+    dataset = datasets.ProteinnetDataset(tmp_path, 'valid')
+    assert dataset._contact_offsets is None
+    for i, item in enumerate(records):
+        np.testing.assert_array_equal(dataset[i][2], _reference_contact_map(item))
+
+
+def _assert_same_value(value, expected):
+    assert type(value) is type(expected)
+    if isinstance(expected, np.ndarray):
+        assert value.dtype == expected.dtype
+        np.testing.assert_array_equal(value, expected)
+    else:
+        assert value == expected
+
+
+def _lmdb_records():
+    rng = np.random.RandomState(0)
+    records = []
+    for i in range(5):
+        record = {'primary': 'ACDE'[:i + 1],
+                  'protein_length': i + 1,
+                  'score': [1, 2.5, 3, 4, 5][i],
+                  'label': np.float32(i),
+                  'is_valid': i % 2 == 0,
+                  'fixed': rng.randn(2, 3),
+                  'ragged': rng.randn(i + 1),
+                  'tertiary': rng.randn(i + 1, 3),
+                  'valid_mask': rng.rand(i + 1) > 0.5,
+                  'name': 'protéine' * i,
+                  'nested': {'a': [i]}}
+        if i % 2:
+            record['optional'] = i
+        if i == 3:
+            record['id'] = 'protein_3'
+        records.append(record)
+    return records
+
+
+def test_in_memory_items_match_lmdb_records(tmp_path):
+    from tape.utils import write_lmdb
+    write_lmdb(str(tmp_path / 'disk.lmdb'), _lmdb_records(), map_size=2 ** 24)
+    write_lmdb(str(tmp_path / 'memory.lmdb'), _lmdb_records(), map_size=2 ** 24)
+    on_disk = datasets.LMDBDataset(tmp_path / 'disk.lmdb')
+    in_memory = datasets.LMDBDataset(tmp_path / 'memory.lmdb', in_memory=True)
+
+    assert len(in_memory) == len(on_disk)
+    for i in range(len(on_disk)):
+        expected, item = on_disk[i], in_memory[i]
+        assert item.keys() == expected.keys()
+        for name in expected:
+            _assert_same_value(item[name], expected[name])
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_out_of_band_lmdb_round_trip(tmp_path, in_memory):
+    from tape.utils import write_lmdb, repack_lmdb
+    records = _lmdb_records()
+    write_lmdb(str(tmp_path / 'in.lmdb'), records, map_size=2 ** 24)
+    repack_lmdb(str(tmp_path / 'in.lmdb'), str(tmp_path / 'out.lmdb'))
+    dataset = datasets.LMDBDataset(tmp_path / 'out.lmdb', in_memory=in_memory)
+
+    assert dataset._out_of_band
+    assert len(dataset) == len(records)
+    for i, expected in enumerate(records):
+        item = dataset[i]
+        expected.setdefault('id', str(i))
+        assert item.keys() == expected.keys()
+        for name in expected:
+            _assert_same_value(item[name], expected[name])
+
+
+def test_bert_mask_does_not_depend_on_numba(monkeypatch):
+    from tape import TAPETokenizer
+    tokenizer = TAPETokenizer(vocab='iupac')
+    dataset = datasets.MaskedLanguageModelingDataset.__new__(
+        datasets.MaskedLanguageModelingDataset)
+    dataset.tokenizer = tokenizer
+    dataset._mask_id = tokenizer.convert_token_to_id(tokenizer.mask_token)
+    token_ids = datasets.encode_cached(tokenizer, 'GCTVEDRCLIGMGAILLNGCVIGSGSLVAAG' * 20)
+
+    implementations = [datasets._bert_mask_ids_loop, datasets._bert_mask_ids_vectorized]
+    if datasets.NUMBA_FOUND:
+        implementations.append(datasets._bert_mask_ids)
+
+    outputs = []
+    for bert_mask_ids in implementations:
+        monkeypatch.setattr(datasets, '_bert_mask_ids', bert_mask_ids)
+        torch.manual_seed(0)
+        outputs.append(dataset._apply_bert_mask(token_ids))
+
+    masked_token_ids, labels = outputs[0]
+    assert (labels != -1).any()
+    assert labels[0] == labels[-1] == -1
+    for other_masked_token_ids, other_labels in outputs[1:]:
+        np.testing.assert_array_equal(other_masked_token_ids, masked_token_ids)
+        np.testing.assert_array_equal(other_labels, labels)
+
+
+def test_pad_sequences_many_matches_pad_sequences():
+    rng = np.random.RandomState(0)
+    token_ids = [rng.randint(0, 25, size=length).astype(np.int32) for length in [7, 3, 5]]
+    input_mask = [np.ones_like(ids, np.uint8) for ids in token_ids]
+    contacts = [rng.randint(-1, 2, size=(len(ids), len(ids))).astype(np.int8)
+                for ids in token_ids]
+    sequences_list = [token_ids, input_mask, contacts]
+    constant_values = [0, 0, -1]
+    dtypes = [None, None, np.int64]
+
+    tensors = datasets.pad_sequences_many(sequences_list, constant_values, dtypes)
+
+    storage_ptr = tensors[0].untyped_storage().data_ptr()
+    for tensor, sequences, constant_value, dtype in zip(
+            tensors, sequences_list, constant_values, dtypes):
+        expected = datasets.pad_sequences(sequences, constant_value)
+        if dtype is not None:
+            expected = expected.astype(dtype)
+        assert tensor.untyped_storage().data_ptr() == storage_ptr
+        assert tensor.data_ptr() % 8 == 0
+        assert tensor.numpy().dtype == expected.dtype
+        np.testing.assert_array_equal(tensor.numpy(), expected)
+
+
+def test_fasta_dataset_matches_records(tmp_path):
+    from Bio import SeqIO
+    data_file = tmp_path / 'proteins.fasta'
+    data_file.write_text('>first description\nGCTVEDRC\nLIGMGA\n'
+                         '>second\nILLNGCVIGSGSLVAAGALITQ\n'
+                         '>third\nM\n')
+    dataset = datasets.FastaDataset(data_file)
+    records = list(SeqIO.parse(str(data_file), 'fasta'))
+
+    assert len(dataset) == len(records)
+    for i, record in enumerate(records):
+        assert dataset[i] == {'id': record.id,
+                              'primary': str(record.seq),
+                              'protein_length': len(record.seq)}
+    with pytest.raises(IndexError):
+        dataset[len(records)]
+
+
+def test_in_memory_cache_is_shared_and_read_only(tmp_path):
+    from tape.utils import write_lmdb
+    write_lmdb(str(tmp_path / 'data.lmdb'), _lmdb_records(), map_size=2 ** 24)
+    dataset = datasets.LMDBDataset(tmp_path / 'data.lmdb', in_memory=True)
+
+    item = dataset[1]
+    for name in ['fixed', 'tertiary']:
+        with pytest.raises(ValueError):
+            item[name][0, 0] = 1.
+
+    # spawned workers receive the dataset pickled, with handles to the shared cache
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=1, collate_fn=list, num_workers=1,
+        multiprocessing_context='spawn')
+    for i, (item,) in enumerate(loader):
+        expected = dataset[i]
+        assert item.keys() == expected.keys()
+        for name in expected:
+            _assert_same_value(item[name], expected[name])
+
+
+def test_contact_map_kernel_survives_fork():
+    import subprocess
+    import sys
+    if not datasets.NUMBA_FOUND:
+        pytest.skip('numba is not installed')
+    # DataLoader workers are forked after the main process may have built contact maps
+    script = '\n'.join([
+        'import os',
+        'import numpy as np',
+        'from tape import datasets',
+        'dataset = datasets.ProteinnetDataset.__new__(datasets.ProteinnetDataset)',
+        "item = {'tertiary': np.random.randn(50, 3) * 8, 'valid_mask': np.ones(50, bool)}",
+        'dataset._compute_contact_map(item)',
+        'pid = os.fork()',
+        'if pid == 0:',
+        '    dataset._compute_contact_map(item)',
+        '    os._exit(0)',
+        'os.waitpid(pid, 0)'])
+    package_root = Path(datasets.__file__).resolve().parents[1]
+    subprocess.run([sys.executable, '-c', script], cwd=package_root, check=True, timeout=120)
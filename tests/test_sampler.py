@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import RandomSampler
+
+from tape.utils._sampler import LengthBucketSampler
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_length_bucket_sampler_covers_every_index(drop_last):
+    lengths = np.random.RandomState(0).randint(10, 1000, size=1003)
+    sampler = RandomSampler(range(len(lengths)))
+    batch_sampler = LengthBucketSampler(sampler, 32, drop_last, lengths)
+    batches = list(batch_sampler)
+
+    assert len(batches) == len(batch_sampler)
+    # only batches made of bucket leftovers mix buckets
+    mixed = [batch for batch in batches if len(set(batch_sampler.bucket_ids[batch])) > 1]
+    assert len(mixed) <= batch_sampler.num_buckets
+    indices = np.concatenate(batches)
+    assert len(indices) == len(np.unique(indices))
+    if drop_last:
+        assert all(len(batch) == 32 for batch in batches)
+        assert len(indices) == len(lengths) // 32 * 32
+    else:
+        assert sorted(indices) == list(range(len(lengths)))
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_length_bucket_sampler_same_length_on_every_rank(drop_last, seed):
+    lengths = np.random.RandomState(seed).randint(10, 1000, size=1003)
+    num_batches = []
+    for rank in range(4):
+        sampler = DistributedSampler(
+            range(len(lengths)), num_replicas=4, rank=rank, seed=seed)
+        batch_sampler = LengthBucketSampler(sampler, 32, drop_last, lengths)
+        assert len(list(batch_sampler)) == len(batch_sampler)
+        num_batches.append(len(batch_sampler))
+    assert len(set(num_batches)) == 1
@@ -0,0 +1,113 @@
+import contextlib
+import threading
+
+import numpy as np
+import pytest
+import torch
+
+from tape.datasets import pad_sequences_many
+from tape.utils import PrefetchLoader
+
+
+class _FakeStream:
+
+    def wait_event(self, event):
+        assert event.recorded
+
+
+class _FakeEvent:
+
+    def __init__(self):
+        self.recorded = False
+
+    def record(self, stream):
+        self.recorded = True
+
+
+@pytest.fixture
+def cpu_streams(monkeypatch):
+    """Replaces the CUDA streams and events used by PrefetchLoader so that its threading
+    can be tested without a GPU. Batches are cloned instead of copied to the device.
+    """
+    monkeypatch.setattr(torch.cuda, 'Stream', lambda device=None: _FakeStream())
+    monkeypatch.setattr(torch.cuda, 'current_stream', lambda device=None: _FakeStream())
+    monkeypatch.setattr(torch.cuda, 'stream', lambda stream: contextlib.nullcontext())
+    monkeypatch.setattr(torch.cuda, 'Event', _FakeEvent)
+    monkeypatch.setattr(torch.Tensor, 'record_stream', lambda self, stream: None)
+    monkeypatch.setattr(PrefetchLoader, '_to_device', lambda self, batch: {
+        name: value.clone() if isinstance(value, torch.Tensor) else value
+        for name, value in batch.items()})
+
+
+def _batches(num_batches):
+    for i in range(num_batches):
+        yield {'input_ids': torch.full([2, 3], i), 'index': i}
+
+
+def test_prefetch_loader_yields_every_batch(cpu_streams):
+    loader = list(_batches(10))
+    prefetch_loader = PrefetchLoader(loader, torch.device('cuda'), depth=2)
+
+    assert len(prefetch_loader) == 10
+    for _ in range(2):
+        batches = list(prefetch_loader)
+        assert [batch['index'] for batch in batches] == list(range(10))
+        for batch in batches:
+            assert (batch['input_ids'] == batch['index']).all()
+
+
+def test_prefetch_loader_raises_loader_errors(cpu_streams):
+
+    def failing_loader():
+        yield from _batches(3)
+        raise RuntimeError('bad batch')
+
+    batches = []
+    with pytest.raises(RuntimeError, match='bad batch'):
+        for batch in PrefetchLoader(failing_loader(), torch.device('cuda')):
+            batches.append(batch)
+    assert len(batches) == 3
+
+
+def test_prefetch_loader_stops_producer_on_early_exit(cpu_streams):
+    produced = []
+
+    class EndlessLoader:
+
+        def __iter__(self):
+            i = 0
+            while True:
+                produced.append(i)
+                yield {'input_ids': torch.zeros(2), 'index': i}
+                i += 1
+
+    num_threads = threading.active_count()
+    iterator = iter(PrefetchLoader(EndlessLoader(), torch.device('cuda'), depth=2))
+    for _ in range(3):
+        next(iterator)
+    iterator.close()
+
+    assert threading.active_count() == num_threads
+    # at most depth batches are queued, plus one held by the producer while it waits
+    assert len(produced) <= 3 + 2 + 1
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires a GPU')
+def test_prefetch_loader_copies_to_gpu():
+    rng = np.random.RandomState(0)
+    loader = []
+    for _ in range(5):
+        sequences = [rng.randint(0, 25, size=length).astype(np.int32) for length in [5, 9]]
+        masks = [np.ones_like(sequence, np.uint8) for sequence in sequences]
+        input_ids, input_mask, targets = pad_sequences_many(
+            [sequences, masks, sequences], [0, 0, -1], [None, None, np.int64])
+        loader.append({'input_ids': input_ids, 'input_mask': input_mask,
+                       'targets': targets, 'index': len(loader)})
+
+    device = torch.device('cuda')
+    for expected, batch in zip(loader, PrefetchLoader(loader, device)):
+        assert batch['index'] == expected['index']
+        for name in ['input_ids', 'input_mask', 'targets']:
+            assert batch[name].device.type == 'cuda'
+            assert batch[name].dtype == expected[name].dtype
+            assert torch.equal(batch[name].cpu(), expected[name])